@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+import numpy as np
+import torch
+from bson.binary import VECTOR_SUBTYPE, Binary, BinaryVectorDtype
+from sentence_transformers import SentenceTransformer
+
+# Header of a BinData int8 vector: the dtype byte followed by the padding byte (always 0 for int8)
+INT8_VECTOR_HEADER = BinaryVectorDtype.INT8.value + b"\x00"
+# Identifies how stored vectors are produced (normalization, quantization, BSON layout);
+# change it whenever that changes so previously ingested data is recognised as outdated.
+VECTOR_FORMAT = "l2-normalized-int8-bindata"
+
+def build_directory_atomically(target_dir, build, complete_file):
+    """
+    Calls build(tmp_dir) on a temporary directory next to target_dir and then renames it into place.
+    A directory at target_dir is therefore always complete, even if a save was interrupted or several
+    processes (e.g. uvicorn workers) built it at the same time; if another process won, its copy is kept.
+    An existing target_dir without complete_file (a relative path inside it) is left over from an older,
+    interrupted save: it is renamed aside and replaced, never deleted in place under another process.
+    """
+    parent_dir = os.path.dirname(target_dir) or "."
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp-")
+    stale_dir = None
+    try:
+        build(tmp_dir)
+        try:
+            os.rename(tmp_dir, target_dir)
+        except OSError:
+            if os.path.exists(os.path.join(target_dir, complete_file)):
+                return # Another process renamed a complete copy into place first
+            if not os.path.isdir(target_dir):
+                raise
+            stale_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".stale-")
+            try:
+                os.rename(target_dir, stale_dir)
+            except FileNotFoundError:
+                pass # Another process moved the stale copy aside already
+            try:
+                os.rename(tmp_dir, target_dir)
+            except OSError:
+                if not os.path.exists(os.path.join(target_dir, complete_file)):
+                    raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if stale_dir is not None:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+def cpu_supports_bf16():
+    """Checks the CPU flags for native bfloat16 support (AVX-512 BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            cpu_flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in cpu_flags or "amx_bf16" in cpu_flags
+
+@lru_cache(maxsize=None)
+def load_model(model_name):
+    """
+    Loads the SentenceTransformer once per process, in a reduced-precision dtype where the hardware
+    runs it natively: float16 on CUDA, bfloat16 on CPUs with BF16/AMX, float32 otherwise.
+    The first call saves a safetensors copy under LOCAL_MODEL_DIR. Later loads read the weights through
+    mmap instead of downloading or unpickling a checkpoint, which avoids a transient second copy in memory.
+    """
+    local_model_dir = os.path.join(os.getenv("LOCAL_MODEL_DIR", "st_model"), model_name.replace("/", "__"))
+    # modules.json is written last by SentenceTransformer.save; without it the folder would load with
+    # default mean pooling and no Normalize module. A folder missing it is an interrupted save from an
+    # older run and is rebuilt.
+    if not os.path.exists(os.path.join(local_model_dir, "modules.json")):
+        print(f"Saving a local safetensors copy of {model_name} to {local_model_dir} (one-time)...")
+        build_directory_atomically(
+            local_model_dir,
+            lambda tmp_dir: SentenceTransformer(model_name).save(tmp_dir, safe_serialization=True),
+            complete_file="modules.json"
+        )
+
+    model = SentenceTransformer(local_model_dir)
+    if model.device.type == "cuda":
+        model.half()
+    elif model.device.type == "cpu" and cpu_supports_bf16():
+        model.to(torch.bfloat16)
+    return model
+
+def quantize_int8(vectors):
+    """
+    L2-normalizes embeddings and scales them to int8 values in [-127, 127].
+    Accepts a single vector or an (n, dim) matrix. Used by both the ingest scripts and the API,
+    so stored vectors and query vectors always go through the same quantization.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    normalized = vectors / np.maximum(norms, 1e-12)
+    return np.clip(np.rint(normalized * 127), -127, 127).astype(np.int8)
+
+def to_bson_vector(vector):
+    """Wraps an int8-quantized vector as a BSON BinData vector for MongoDB."""
+    return Binary(INT8_VECTOR_HEADER + np.ascontiguousarray(vector, dtype=np.int8).tobytes(), VECTOR_SUBTYPE)
+
+def to_bson_vectors(vectors):
+    """
+    Converts an (n, dim) int8 matrix into a list of BSON BinData vectors.
+    Each row's raw bytes are copied straight into the BinData payload (the same layout
+    Binary.from_vector produces), so no Python number objects are created per element.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.int8)
+    return [Binary(INT8_VECTOR_HEADER + row.tobytes(), VECTOR_SUBTYPE) for row in vectors]
@@ -1,10 +1,15 @@
 import os
-import glob
+import hashlib
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 from dotenv import load_dotenv
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from sentence_transformers import SentenceTransformer
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from transcript_splitter import init_splitter_worker, read_and_split
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,8 +18,30 @@ load_dotenv()
 MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
 DB_NAME = os.getenv("DB_NAME")
 KNOWLEDGE_CHUNKS_COLLECTION_NAME = os.getenv("KNOWLEDGE_CHUNKS_COLLECTION_NAME")
+INGEST_STATE_COLLECTION_NAME = os.getenv("INGEST_STATE_COLLECTION_NAME", "ingest_state") # Hash of each ingested file
 MODEL_NAME = os.getenv("MODEL_NAME")
-TRANSCRIPTS_PATH = "transcripts/*.txt" # Path to find all .txt files in the transcripts folder
+TRANSCRIPTS_DIR = Path("transcripts") # Folder holding the transcript files
+TRANSCRIPTS_PATTERN = "*.txt" # Pattern for the transcript files inside TRANSCRIPTS_DIR
+ENCODE_BATCH_SIZE = 64 # Number of chunks sent through the model per forward pass
+INSERT_BATCH_SIZE = 100 # Number of documents sent to MongoDB per insert_many call
+INSERT_QUEUE_SIZE = 8 # Max encoded batches waiting for the writer thread
+CHUNK_TOKENS = 256 # Target tokens per chunk, capped by the model's max sequence length
+CHUNK_OVERLAP_TOKENS = 32 # Tokens shared between consecutive chunks
+CHUNK_TOKEN_HEADROOM = 8 # Spare tokens below the model limit; re-tokenizing a chunk can yield a few more tokens
+SPLITTER_MAX_WORKERS = 4 # Max processes reading and splitting transcripts; splitting is far cheaper than encoding
+
+def insert_worker(insert_queue, collection, failed_sources):
+    """
+    Runs in a background thread: drains document batches from the queue and inserts them,
+    so MongoDB writes overlap with the encoding of the next batch. Stops on a None sentinel.
+    The source_name of every batch that fails to insert is added to failed_sources.
+    """
+    while (batch := insert_queue.get()) is not None:
+        try:
+            collection.insert_many(batch, ordered=False)
+        except Exception as e:
+            print(f"Error inserting batch into MongoDB: {e}")
+            failed_sources.update(document["source_name"] for document in batch)
 
 def main():
     """
@@ -26,10 +53,15 @@ def main():
 
     print("Starting knowledge chunk ingestion process...")
 
+    # Imported here rather than at the top: spawned splitter workers re-import this script as their
+    # main module, and a module-level import would load torch and sentence-transformers in each of them.
+    import torch
+    from embedding_utils import VECTOR_FORMAT, load_model, quantize_int8, to_bson_vectors
+
     # --- 1. Initialize Models and Database Connection ---
     print(f"Loading sentence transformer model: {MODEL_NAME}...")
     try:
-        model = SentenceTransformer(MODEL_NAME)
+        model = load_model(MODEL_NAME)
         print("Model loaded successfully.")
     except Exception as e:
         print(f"Error loading model: {e}")
@@ -41,70 +73,148 @@ def main():
         client.admin.command('ping')
         db = client[DB_NAME]
         collection = db[KNOWLEDGE_CHUNKS_COLLECTION_NAME]
+        state_collection = db[INGEST_STATE_COLLECTION_NAME]
+        # Re-ingesting a file deletes its chunks by source_name; the index keeps that from scanning the collection.
+        collection.create_index([("source_name", 1)])
         print("Successfully connected to MongoDB.")
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
         return
 
-    # --- 2. Initialize the Text Splitter ---
-    # We use RecursiveCharacterTextSplitter for effective, semantic chunking.
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, # Max characters per chunk
-        chunk_overlap=100  # Characters to overlap between chunks
-    )
-
-    # --- 3. Find and Process Each Transcript File ---
-    transcript_files = glob.glob(TRANSCRIPTS_PATH)
+    # --- 2. Find and Process Each Transcript File ---
+    transcript_files = list(TRANSCRIPTS_DIR.glob(TRANSCRIPTS_PATTERN))
     if not transcript_files:
-        print(f"No transcript files found at '{TRANSCRIPTS_PATH}'. Please check the path.")
+        print(f"No transcript files found at '{TRANSCRIPTS_DIR / TRANSCRIPTS_PATTERN}'. Please check the path.")
         return
         
-    print(f"Found {len(transcript_files)} transcript files to process.")
-
+    print(f"Found {len(transcript_files)} transcript files.")
+
+    # Chunks are sized in model tokens so each one nearly fills the model's input window, minus the two
+    # special tokens added at encode time and some headroom, since a chunk re-tokenized on its own
+    # can come out slightly longer. This avoids truncation and half-empty batches.
+    chunk_tokens = min(CHUNK_TOKENS, model.max_seq_length - 2 - CHUNK_TOKEN_HEADROOM)
+    ingest_settings = {
+        "model_name": MODEL_NAME,
+        "vector_format": VECTOR_FORMAT,
+        "chunk_tokens": chunk_tokens,
+        "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS,
+    }
+
+    # Files whose content hash and ingest settings (model, vector format, chunking) match those stored
+    # by the previous run are skipped entirely, so unchanged transcripts are never re-embedded.
+    stored_states = {
+        state["source_name"]: state
+        for state in state_collection.find({}, {"source_name": 1, "sha256": 1, "ingest_settings": 1})
+    }
+    file_states = {}
     for filepath in transcript_files:
-        source_name = os.path.basename(filepath)
-        print(f"\n--- Processing file: {source_name} ---")
-
-        # To make this script re-runnable, we first delete existing chunks from this specific source.
-        print(f"Deleting existing chunks for source: {source_name}...")
-        collection.delete_many({"source_name": source_name})
-
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                full_text = f.read()
+            sha256 = hashlib.sha256(filepath.read_bytes()).hexdigest()
         except Exception as e:
             print(f"Error reading file {filepath}: {e}")
-            continue # Skip to the next file
+            continue
+        stored_state = stored_states.get(filepath.name, {})
+        if stored_state.get("sha256") == sha256 and stored_state.get("ingest_settings") == ingest_settings:
+            print(f"Skipping unchanged file: {filepath.name}")
+            continue
+        file_states[filepath] = {"sha256": sha256, "mtime": filepath.stat().st_mtime, "ingest_settings": ingest_settings}
 
-        # --- 4. Chunk the Text ---
-        print("Splitting text into chunks...")
-        chunks = text_splitter.split_text(full_text)
-        print(f"Text split into {len(chunks)} chunks.")
+    if not file_states:
+        print("All transcript files are up to date.")
+        return
 
-        if not chunks:
-            print("No chunks were generated for this file.")
-            continue
+    transcript_files = list(file_states)
+    print(f"{len(transcript_files)} transcript files changed and will be processed.")
 
-        # --- 5. Generate Embeddings and Prepare Documents ---
-        print("Generating embeddings for each chunk...")
-        documents_to_insert = []
-        for i, chunk_text in enumerate(chunks):
-            chunk_vector = model.encode(chunk_text).tolist()
-            
-            document = {
-                "source_type": "transcript",
-                "source_name": source_name,
-                "content": chunk_text,
-                "content_vector": chunk_vector,
-                "chunk_number": i + 1,
-            }
-            documents_to_insert.append(document)
-
-        # --- 6. Batch Insert into MongoDB ---
-        if documents_to_insert:
-            print(f"Inserting {len(documents_to_insert)} new chunks into MongoDB...")
-            collection.insert_many(documents_to_insert)
-            print("Insertion complete for this source.")
+    # Encoded batches are handed to a writer thread; the bounded queue keeps memory in check
+    # if MongoDB falls behind the encoder. Inserts are acknowledged, so a rejected batch is
+    # reported and its file is not recorded as ingested.
+    insert_queue = queue.Queue(maxsize=INSERT_QUEUE_SIZE)
+    failed_sources = set()
+    writer = threading.Thread(target=insert_worker, args=(insert_queue, collection, failed_sources))
+    writer.start()
+
+    ingested_files = []
+    try:
+        # --- 3. Read and Chunk the Text in Worker Processes ---
+        # Files are read and split in a process pool; results arrive in order while the
+        # main process is busy encoding the previous file. Workers are spawned rather than forked:
+        # the writer thread and the MongoClient's monitor threads are already running here, and
+        # forking a multi-threaded process can deadlock the child. They receive only the Rust tokenizers.Tokenizer
+        # behind the model's tokenizer, which pickles cheaply and needs no transformers import.
+        with ProcessPoolExecutor(
+            max_workers=min(SPLITTER_MAX_WORKERS, os.cpu_count() or 1, len(transcript_files)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_splitter_worker,
+            initargs=(model.tokenizer.backend_tokenizer,)
+        ) as executor:
+            for filepath, chunks in executor.map(
+                partial(read_and_split, chunk_tokens=chunk_tokens, overlap_tokens=CHUNK_OVERLAP_TOKENS),
+                transcript_files
+            ):
+                source_name = filepath.name
+                print(f"\n--- Processing file: {source_name} ---")
+
+                # To make this script re-runnable, we first delete existing chunks from this specific source.
+                print(f"Deleting existing chunks for source: {source_name}...")
+                collection.delete_many({"source_name": source_name})
+
+                if chunks is None:
+                    continue # Reading failed; skip to the next file
+
+                print(f"Text split into {len(chunks)} chunks.")
+                if not chunks:
+                    print("No chunks were generated for this file.")
+                    ingested_files.append(filepath)
+                    continue
+
+                # --- 4. Generate Embeddings and Queue Documents for Insertion ---
+                # The whole file is encoded in one call so every forward pass is a full, length-sorted batch;
+                # the documents then go to the writer thread in insert-sized batches.
+                print(f"Generating embeddings for {len(chunks)} chunks...")
+                with torch.inference_mode():
+                    chunk_vectors = quantize_int8(model.encode(
+                        chunks,
+                        batch_size=ENCODE_BATCH_SIZE,
+                        convert_to_numpy=True,
+                        show_progress_bar=False
+                    ))
+
+                documents = [
+                    {
+                        "source_type": "transcript",
+                        "source_name": source_name,
+                        "content": chunk_text,
+                        "content_vector": chunk_vector,
+                        "chunk_number": i + 1,
+                    }
+                    for i, (chunk_text, chunk_vector) in enumerate(zip(chunks, to_bson_vectors(chunk_vectors)))
+                ]
+                for start in range(0, len(documents), INSERT_BATCH_SIZE):
+                    insert_queue.put(documents[start:start + INSERT_BATCH_SIZE])
+
+                print("Insertion queued for this source.")
+                ingested_files.append(filepath)
+    finally:
+        # --- 5. Wait for the Writer Thread to Flush All Batches ---
+        insert_queue.put(None)
+        writer.join()
+
+    # --- 6. Record the Hashes of the Ingested Files ---
+    # Only done once every batch has been acknowledged by MongoDB, and never for a file with a failed
+    # insert, so an interrupted or failed file is re-processed on the next run.
+    for filepath in ingested_files:
+        if filepath.name in failed_sources:
+            continue
+        state_collection.update_one(
+            {"source_name": filepath.name},
+            {"$set": file_states[filepath]},
+            upsert=True
+        )
+
+    if failed_sources:
+        print(f"\nFinished with insert errors for: {', '.join(sorted(failed_sources))}. They will be retried on the next run.")
+        return
         
     print("\nAll transcript files processed successfully.")
 
@@ -2,7 +2,9 @@ import json, os
 from dotenv import load_dotenv
 from pymongo.mongo_client import MongoClient # Updated import
 from pymongo.server_api import ServerApi      # New import
-from sentence_transformers import SentenceTransformer
+from pymongo.write_concern import WriteConcern
+import torch
+from embedding_utils import load_model, quantize_int8, to_bson_vectors
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,6 +15,8 @@ DB_NAME = os.getenv("DB_NAME")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 MODEL_NAME = os.getenv("MODEL_NAME")
 JSON_FILE_PATH = "webinars.json"
+ENCODE_BATCH_SIZE = 64 # Number of questions sent through the model per forward pass
+INSERT_BATCH_SIZE = 100 # Number of documents sent to MongoDB per insert_many call
 
 def main():
     """
@@ -30,6 +34,8 @@ def main():
         
         db = client[DB_NAME]
         collection = db[COLLECTION_NAME]
+        # This is a one-time bulk load, so inserts skip acknowledgement to avoid a round-trip per batch.
+        fast_collection = collection.with_options(write_concern=WriteConcern(w=0))
         # ...
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
@@ -38,7 +44,7 @@ def main():
     # 2. Load the embedding model
     print(f"Loading sentence transformer model: {MODEL_NAME}...")
     try:
-        model = SentenceTransformer(MODEL_NAME)
+        model = load_model(MODEL_NAME)
         print("Model loaded successfully.")
     except Exception as e:
         print(f"Error loading model: {e}")
@@ -53,22 +59,35 @@ def main():
         print(f"Error reading JSON file: {e}")
         return
 
-    # 4. Process and prepare documents for insertion
-    documents_to_insert = []
-    print("Generating embeddings and preparing documents...")
+    # 4. Collect the valid Q&A items
+    valid_items = []
     for item in qas:
         question = item.get("question")
         if not question:
             print(f"Skipping item due to missing question: {item}")
             continue
+        valid_items.append(item)
 
-        # Generate the vector embedding for the question
-        question_vector = model.encode(question).tolist()
+    if not valid_items:
+        print("No documents were prepared for insertion.")
+        return
+
+    # 5. Generate embeddings and prepare documents for insertion
+    # All questions are encoded in one batched call. SentenceTransformer sorts the inputs by length
+    # internally before batching (and restores the original order), so batches carry minimal padding.
+    print("Generating embeddings and preparing documents...")
+    with torch.inference_mode():
+        question_vectors = quantize_int8(model.encode(
+            [item["question"] for item in valid_items],
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ))
 
-        # Create the document for MongoDB
-        document = {
+    documents_to_insert = [
+        {
             "source": "webinar",
-            "questionText": question,
+            "questionText": item["question"],
             "answerText": item.get("answer"),
             "questionVector": question_vector,
             "sourceDetails": {
@@ -76,13 +95,15 @@ def main():
                 "webinarDate": item.get("webinar_date")
             }
         }
-        documents_to_insert.append(document)
+        for item, question_vector in zip(valid_items, to_bson_vectors(question_vectors))
+    ]
     
-    # 5. Batch insert documents into MongoDB
+    # 6. Batch insert documents into MongoDB
     if documents_to_insert:
         try:
-            collection.insert_many(documents_to_insert)
-            print(f"Successfully inserted {len(documents_to_insert)} documents into MongoDB.")
+            for start in range(0, len(documents_to_insert), INSERT_BATCH_SIZE):
+                fast_collection.insert_many(documents_to_insert[start:start + INSERT_BATCH_SIZE], ordered=False)
+            print(f"Sent {len(documents_to_insert)} documents to MongoDB (unacknowledged writes).")
         except Exception as e:
             print(f"Error inserting documents into MongoDB: {e}")
     else:
@@ -1,14 +1,32 @@
 import os
-from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+
+# Load environment variables from .env file at the very top
+load_dotenv()
+
+# The encoder's thread count has to be in the environment before torch / onnxruntime are imported.
+# Under several uvicorn workers, keep workers * ENCODER_NUM_THREADS close to the number of physical cores.
+# If only OMP_NUM_THREADS is set, it is used, so OpenMP/MKL, torch and onnxruntime all run with the same count.
+ENCODER_NUM_THREADS = int(os.getenv("ENCODER_NUM_THREADS") or os.getenv("OMP_NUM_THREADS") or "4")
+os.environ["OMP_NUM_THREADS"] = str(ENCODER_NUM_THREADS)
+os.environ["MKL_NUM_THREADS"] = str(ENCODER_NUM_THREADS)
+
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+import onnxruntime
+import torch
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from pymongo.mongo_client import MongoClient
+from pymongo import AsyncMongoClient
 from pymongo.server_api import ServerApi
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+from embedding_utils import build_directory_atomically, load_model, quantize_int8, to_bson_vector
 
-# Load environment variables from .env file at the very top
-load_dotenv()
+# set_num_interop_threads may only be called once per process, so this lives here and not in the lifespan.
+torch.set_num_threads(ENCODER_NUM_THREADS)
+torch.set_num_interop_threads(1)
 
 # --- Configuration (loaded from environment) ---
 MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING")
@@ -16,6 +34,139 @@ DB_NAME = os.getenv("DB_NAME")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 MODEL_NAME = os.getenv("MODEL_NAME")
 VECTOR_SEARCH_INDEX = os.getenv("VECTOR_SEARCH_INDEX")
+VS_NUM_CANDIDATES = int(os.getenv("VS_NUM_CANDIDATES", "150")) # HNSW candidates considered per query
+VS_LIMIT = int(os.getenv("VS_LIMIT", "5")) # Matches returned per query; only the best one drives the action
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_model") # Local folder for the exported ONNX models, one per model
+QUANTIZED_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx" # Written by export_dynamic_quantized_onnx_model
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32")) # Max questions per model call
+QUERY_BATCH_TIMEOUT_MS = float(os.getenv("QUERY_BATCH_TIMEOUT_MS", "10")) # Max wait for a batch to fill up
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")) # Max cached question embeddings
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "3600")) # Lifetime of a cached embedding
+
+def load_query_encoder():
+    """
+    Loads the model used to encode incoming questions. With a CUDA GPU it is the PyTorch model in float16;
+    on CPU it is the int8-quantized ONNX version, exported once per model and then loaded from ONNX_MODEL_DIR.
+    """
+    if torch.cuda.is_available():
+        print("CUDA is available: running the encoder on the GPU in float16.")
+        return load_model(MODEL_NAME) # Placed on CUDA and cast to float16
+
+    # Keyed by model name, so changing MODEL_NAME never serves a stale export whose vectors don't match the stored ones.
+    onnx_model_dir = os.path.join(ONNX_MODEL_DIR, MODEL_NAME.replace("/", "__"))
+    if not os.path.exists(os.path.join(onnx_model_dir, QUANTIZED_ONNX_FILE)):
+        print(f"Exporting {MODEL_NAME} to ONNX with dynamic int8 quantization (one-time)...")
+
+        def export(tmp_dir):
+            onnx_model = SentenceTransformer(MODEL_NAME, backend="onnx")
+            onnx_model.save(tmp_dir)
+            export_dynamic_quantized_onnx_model(onnx_model, "avx512_vnni", tmp_dir)
+
+        build_directory_atomically(onnx_model_dir, export, complete_file=QUANTIZED_ONNX_FILE)
+
+    # The QueryBatcher runs one model call at a time, so all threads go to intra-op parallelism.
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = ENCODER_NUM_THREADS
+    session_options.inter_op_num_threads = 1
+
+    return SentenceTransformer(
+        onnx_model_dir,
+        backend="onnx",
+        model_kwargs={"file_name": QUANTIZED_ONNX_FILE, "session_options": session_options}
+    )
+
+
+# --- Dynamic Query Batching ---
+class QueryBatcher:
+    """
+    Gathers questions from concurrent requests and encodes them together in a single model call.
+    A batch is flushed when it holds max_batch_size questions or timeout_ms after its first question arrived.
+    """
+    def __init__(self, model, max_batch_size, timeout_ms):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout_ms / 1000
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._worker
+
+    async def encode(self, text):
+        """Queues a single question and waits for its embedding."""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.timeout
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # The forward pass runs in a worker thread so the event loop keeps accepting requests.
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await asyncio.to_thread(
+                    self.model.encode,
+                    texts,
+                    batch_size=len(texts),
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done(): # The request may have been cancelled while waiting
+                    future.set_result(vector)
+
+
+# --- Embedding Cache ---
+class CachedEncoder:
+    """
+    LRU cache with a time-to-live in front of the QueryBatcher, keyed on the normalized question text.
+    The question itself is encoded with its casing intact, since the stored questions were encoded that way
+    and the model is case-sensitive. The cache holds the final int8 BinData query vector rather than a
+    view into the batcher's output array.
+    It is only used from the event loop thread, so lookups and evictions need no locking.
+    """
+    def __init__(self, batcher, max_size, ttl_seconds):
+        self.batcher = batcher
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._cache = OrderedDict() # key -> (inserted_at, query_vector), least recently used first
+
+    async def encode(self, question):
+        key = question.strip().lower()
+        entry = self._cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(key)
+            return entry[1]
+
+        query_vector = to_bson_vector(quantize_int8(await self.batcher.encode(question.strip())))
+        self._cache[key] = (time.monotonic(), query_vector)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return query_vector
+
 
 # --- Lifespan Event Handler ---
 # This context manager will handle startup and shutdown events
@@ -30,11 +181,25 @@ async def lifespan(app: FastAPI):
         raise RuntimeError("MONGO_CONNECTION_STRING not found in .env file")
 
     # Store resources in the app state to be accessible by endpoints
-    app.state.model = SentenceTransformer(MODEL_NAME)
-    print("SentenceTransformer model loaded.")
+    app.state.model = load_query_encoder()
+    print("SentenceTransformer query encoder loaded.")
+
+    # Encode one maximum-size batch at startup. ONNX Runtime's CPU memory arena (or PyTorch's CUDA caching
+    # allocator) grows to its peak size here and later batches reuse those buffers, so the first requests
+    # do not pay for allocations.
+    warmup_text = "warmup " * app.state.model.max_seq_length # Truncated to max_seq_length tokens
+    app.state.model.encode(
+        [warmup_text] * QUERY_BATCH_MAX_SIZE,
+        batch_size=QUERY_BATCH_MAX_SIZE,
+        show_progress_bar=False
+    )
+
+    app.state.batcher = QueryBatcher(app.state.model, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_TIMEOUT_MS)
+    app.state.batcher.start()
+    app.state.encode = CachedEncoder(app.state.batcher, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL_SECONDS).encode
     
-    app.state.db_client = MongoClient(MONGO_CONNECTION_STRING, server_api=ServerApi('1'))
-    app.state.db_client.admin.command('ping')
+    app.state.db_client = AsyncMongoClient(MONGO_CONNECTION_STRING, server_api=ServerApi('1'))
+    await app.state.db_client.admin.command('ping')
     print("Successfully connected to MongoDB.")
     
     app.state.db_collection = app.state.db_client[DB_NAME][COLLECTION_NAME]
@@ -43,7 +208,8 @@ async def lifespan(app: FastAPI):
 
     # === Code to run on SHUTDOWN ===
     print("Application shutdown: Closing resources...")
-    app.state.db_client.close()
+    await app.state.batcher.stop()
+    await app.state.db_client.close()
     print("MongoDB connection closed.")
 
 
@@ -65,26 +231,28 @@ class APIResponse(BaseModel):
 
 # --- API Endpoints ---
 @app.post("/find-similar-question", response_model=APIResponse)
-def find_similar_question(request: QuestionRequest):
+async def find_similar_question(request: QuestionRequest):
     """
     Accepts a question, finds the most similar one in the knowledge base,
     and returns an action based on the similarity score.
     """
     # 1. Generate embedding for the incoming question
     try:
-        incoming_vector = app.state.model.encode(request.question).tolist()
+        incoming_vector = await app.state.encode(request.question)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to encode question: {e}")
 
     # 2. Build the MongoDB Vector Search query
+    # questionVector is stored as int8-quantized BinData (same quantization as the query), indexed in Atlas as
+    # {"type": "vector", "path": "questionVector", "numDimensions": <model dim>, "similarity": "cosine"}.
     pipeline = [
         {
             "$vectorSearch": {
                 "index": VECTOR_SEARCH_INDEX,
                 "path": "questionVector",
                 "queryVector": incoming_vector,
-                "numCandidates": 10,
-                "limit": 1
+                "numCandidates": VS_NUM_CANDIDATES,
+                "limit": VS_LIMIT
             }
         },
         {
@@ -99,7 +267,8 @@ def find_similar_question(request: QuestionRequest):
 
     # 3. Execute the query
     try:
-        results = list(app.state.db_collection.aggregate(pipeline))
+        cursor = await app.state.db_collection.aggregate(pipeline)
+        results = await cursor.to_list(length=VS_LIMIT)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database query failed: {e}")
 
@@ -112,6 +281,9 @@ def find_similar_question(request: QuestionRequest):
         )
     
     top_match = results[0]
+    if len(results) > 1:
+        # The runner-up score shows how close the nearest miss was, which helps when tuning the thresholds.
+        print(f"Vector search: best score {top_match.get('score'):.4f}, runner-up {results[1].get('score'):.4f}")
     similarity_score = top_match.get("score")
     retrieved_answer = top_match.get("answerText")
     retrieved_question = top_match.get("questionText")
@@ -0,0 +1,62 @@
+from bisect import bisect_right
+
+# Kept free of torch, sentence-transformers and embedding_utils: spawned splitter workers import this
+# module, and they only need a tokenizers.Tokenizer to split text.
+
+# Set in each worker process by init_splitter_worker
+worker_tokenizer = None
+
+def split_text_by_tokens(text, tokenizer, chunk_tokens, overlap_tokens):
+    """
+    Splits text into chunks of at most chunk_tokens model tokens, with about overlap_tokens shared
+    between neighbours. The text is tokenized once and chunks are cut only at tokens that start a
+    word (preceded by whitespace), so no chunk starts or ends mid-word; a single word longer than
+    a whole chunk is the only exception. Every chunk is a verbatim slice of the text.
+    """
+    offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+    word_starts = [
+        i for i, (char_start, _) in enumerate(offsets)
+        if i == 0 or char_start == 0 or text[char_start - 1].isspace()
+    ]
+
+    chunks = []
+    start = 0
+    while start < len(offsets):
+        if start + chunk_tokens >= len(offsets):
+            end = len(offsets)
+        else:
+            # Last word start that keeps the chunk within chunk_tokens
+            end = word_starts[bisect_right(word_starts, start + chunk_tokens) - 1]
+            if end <= start:
+                end = start + chunk_tokens # One word longer than a chunk; cut it
+        chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+        if end == len(offsets):
+            break
+
+        next_start = word_starts[bisect_right(word_starts, end - overlap_tokens) - 1]
+        start = next_start if next_start > start else end
+    return chunks
+
+def init_splitter_worker(tokenizer):
+    """
+    Stores the model's tokenizers.Tokenizer once per worker process. Truncation and padding are
+    switched off on this copy, since whole transcripts are tokenized and far exceed the model's max length.
+    """
+    global worker_tokenizer
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    worker_tokenizer = tokenizer
+
+def read_and_split(filepath, chunk_tokens, overlap_tokens):
+    """
+    Reads a transcript file and splits it into token-sized chunks. Runs in a worker process, so
+    splitting of upcoming files overlaps with encoding in the main process.
+    Returns (filepath, chunks), with chunks set to None if the file could not be read.
+    """
+    try:
+        full_text = filepath.read_text(encoding='utf-8')
+    except Exception as e:
+        print(f"Error reading file {filepath}: {e}")
+        return filepath, None
+
+    return filepath, split_text_by_tokens(full_text, worker_tokenizer, chunk_tokens, overlap_tokens)